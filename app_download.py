@@ -1,20 +1,54 @@
+import atexit
 import configparser
+import email.utils
 import json
 import requests
+import shutil
+import sqlite3
 import sys
 import os
 import time
 import logging
-from datetime import datetime
+import logging.handlers
+import mmap
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+# orjson is optional, it parses the large invoice pages much faster than the standard library
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Log file, also read once when migrating state from older versions
+LOG_FILE = 'xero_download.log'
+PROCESSED_INVOICE_RE = re.compile(rb'Processing invoice:.*?ID: ([^,\r\n]+)')
+
+# Xero sends dates such as UpdatedDateUTC as /Date(1573755038314+0000)/
+XERO_DATE_RE = re.compile(r'/Date\((-?\d+)')
+
+# Set up logging, file writes are buffered and flushed every LOG_BUFFER_SIZE records,
+# on errors and at exit, the console gets the same records straight away
+LOG_BUFFER_SIZE = 512
+log_format = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+file_handler = logging.FileHandler(LOG_FILE)
+file_handler.setFormatter(log_format)
+memory_handler = logging.handlers.MemoryHandler(LOG_BUFFER_SIZE, flushLevel=logging.ERROR, target=file_handler)
+console_handler = logging.StreamHandler(sys.stdout)
+console_handler.setFormatter(log_format)
 
-# Set up logging
-logging.basicConfig(
-    filename='xero_download.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
 logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+logger.addHandler(memory_handler)
+logger.addHandler(console_handler)
+atexit.register(memory_handler.flush)
 
 # Xero API endpoints
 XERO_TOKEN_URL = "https://identity.xero.com/connect/token"
@@ -22,7 +56,55 @@ XERO_CONNECTIONS_URL = "https://api.xero.com/connections"
 XERO_CONTACTS_URL = "https://api.xero.com/api.xro/2.0/Contacts"
 XERO_INVOICES_URL = "https://api.xero.com/api.xro/2.0/Invoices"
 
-# File to store downloaded attachments
+# Shared session so every call reuses pooled keep-alive connections
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        # 429s are left to get_xero_api and XeroLimiter, which can tell the minute and daily limits apart
+        status_forcelist=[500, 502, 503, 504],
+        respect_retry_after_header=True,
+        raise_on_status=False
+    )
+))
+SESSION.headers.update({'Accept-Encoding': 'gzip, deflate'})
+
+# Attachments are streamed to disk in chunks of this size
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+ATTACHMENT_HEADERS = {'Accept': 'application/octet-stream'}
+
+# Attachments are written into this subfolder of the supplier folder and only moved out once complete,
+# being a directory it can never be mistaken for a downloaded attachment
+PARTIAL_DIR = '.partial'
+
+# Characters that can't appear in file names on Windows, macOS or Linux
+SANITIZE_TABLE = str.maketrans({char: '_' for char in '/\\:*?"<>|'})
+
+# Xero allows 60 calls per minute and at most 5 calls in flight at once,
+# we stay a little under the minute limit and back off when Xero says it is nearly used up
+RATE_LIMIT_CALLS = 55
+RATE_LIMIT_PERIOD = 60
+RATE_LIMIT_THRESHOLD = 2
+RATE_LIMIT_RETRIES = 3
+# A 429 asking us to wait longer than this is treated as the daily limit
+MAX_RETRY_AFTER = 300
+MAX_WORKERS = 5
+
+# Invoice pages are fetched PAGE_WINDOW at a time, Xero returns at most INVOICE_PAGE_SIZE per page
+INVOICE_PAGE_SIZE = 100
+PAGE_WINDOW = 4
+
+# SQLite database recording processed invoices and downloaded attachments
+STATE_DB_FILE = "state.db"
+
+# Access token cache, client credentials tokens are valid for 30 minutes
+TOKEN_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".xero_tool", "token.json")
+TOKEN_EXPIRY_MARGIN = 60
+
+# File older versions used to store downloaded attachments, imported into STATE_DB_FILE
 DOWNLOADED_SET_FILE = "downloaded_attachments.json"
 
 # Read config.ini
@@ -35,7 +117,6 @@ try:
     SUPPLIER_NAME = config['DEFAULT']['SUPPLIER_NAME']
     START_DATE = config['DEFAULT']['START_DATE']
 except KeyError as e:
-    print(f"Missing required config key: {e}")
     logger.error(f"Missing required config key: {e}")
     sys.exit(1)
 
@@ -43,267 +124,609 @@ except KeyError as e:
 try:
     start_date = datetime.strptime(START_DATE, '%Y-%m-%d')
 except ValueError:
-    print("START_DATE must be in YYYY-MM-DD format (e.g., 2019-07-05)")
     logger.error("START_DATE must be in YYYY-MM-DD format")
     sys.exit(1)
 
 
-def get_token():
+def header_int(response, header):
+    """Return an integer response header, or None if it is missing or malformed."""
+    try:
+        return int(response.headers[header])
+    except (KeyError, ValueError):
+        return None
+
+
+def retry_after_seconds(response, default):
+    """Return how long Retry-After asks us to wait, it may be given in seconds or as an HTTP date."""
+    value = response.headers.get('Retry-After')
+    if value is None:
+        return default
+    try:
+        return max(0, int(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+
+class DailyLimitReached(Exception):
+    """Raised instead of making a call once Xero's daily API limit is used up."""
+
+
+class XeroLimiter:
+    """
+    Thread-safe limiter allowing at most `calls` requests in any `period` seconds
+    Responses are fed back through update() so every worker pauses when Xero
+    reports its remaining minute quota is at or below `threshold`, and
+    once the daily quota is used up acquire() raises DailyLimitReached
+    """
+
+    def __init__(self, calls, period, threshold):
+        self.calls = calls
+        self.period = period
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._timestamps = deque()
+        self._paused_until = 0
+        self.day_limit_reached = False
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                if self.day_limit_reached:
+                    raise DailyLimitReached("Xero daily API limit reached")
+                now = time.monotonic()
+                while self._timestamps and now - self._timestamps[0] >= self.period:
+                    self._timestamps.popleft()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif len(self._timestamps) < self.calls:
+                    self._timestamps.append(now)
+                    return
+                else:
+                    wait = self.period - (now - self._timestamps[0])
+            time.sleep(wait)
+
+    def update(self, response):
+        day_remaining = header_int(response, 'X-DayLimit-Remaining')
+        min_remaining = header_int(response, 'X-MinLimit-Remaining')
+        if response.status_code == 429:
+            pause = retry_after_seconds(response, self.period)
+            # Waiting out the daily limit could take hours, stop instead
+            if response.headers.get('X-Rate-Limit-Problem', '').lower() == 'day' or pause > MAX_RETRY_AFTER:
+                self.stop_for_the_day()
+                return
+        elif day_remaining is not None and day_remaining <= self.threshold:
+            self.stop_for_the_day()
+            return
+        elif min_remaining is not None and min_remaining <= self.threshold:
+            # Xero only sends Retry-After on a 429, so wait for the minute window to roll over
+            pause = self.period
+        else:
+            return
+        logger.info(f"Approaching Xero rate limit, pausing requests for {pause:.0f} seconds")
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + pause)
+
+    def stop_for_the_day(self):
+        with self._lock:
+            if self.day_limit_reached:
+                return
+            self.day_limit_reached = True
+        logger.error("Xero daily API limit reached, no further calls will be made until it resets")
+
+
+RATE_LIMITER = XeroLimiter(RATE_LIMIT_CALLS, RATE_LIMIT_PERIOD, RATE_LIMIT_THRESHOLD)
+
+# Guards the state database and downloaded attachments set shared between worker threads
+STATE_LOCK = threading.Lock()
+
+# Makes sure only one worker fetches a new token when the current one is rejected
+TOKEN_LOCK = threading.Lock()
+
+# Statuses that can mean a cached token, tenant ID or ContactID no longer applies
+STALE_LOOKUP_STATUSES = (401, 403, 404)
+
+
+class StaleLookupError(Exception):
+    """Raised when Xero rejects a call in a way that suggests the cached lookups are out of date."""
+
+
+def load_cached_token():
+    """Return the cached access token if it belongs to CLIENT_ID and has not expired."""
+    try:
+        with open(TOKEN_CACHE_FILE, 'r') as f:
+            cached = json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return None
+    if cached.get('client_id') == CLIENT_ID and time.time() < cached.get('expires_at', 0):
+        return cached.get('access_token')
+    return None
+
+
+def save_cached_token(access_token, expires_in):
+    """Atomically write the access token cache, readable only by the current user."""
+    cached = {
+        'client_id': CLIENT_ID,
+        'access_token': access_token,
+        'expires_at': time.time() + expires_in - TOKEN_EXPIRY_MARGIN
+    }
+    tmp_file = f"{TOKEN_CACHE_FILE}.tmp"
+    # The cache is only an optimisation, a home directory we can't write to shouldn't stop the run
+    try:
+        os.makedirs(os.path.dirname(TOKEN_CACHE_FILE), mode=0o700, exist_ok=True)
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cached, f)
+        os.replace(tmp_file, TOKEN_CACHE_FILE)
+    except OSError as e:
+        logger.error(f"Failed to cache token in {TOKEN_CACHE_FILE}: {str(e)}")
+
+
+def get_token(use_cache=True):
+    token = load_cached_token() if use_cache else None
+    if token:
+        logger.info("Using cached token")
+        return token
+
     headers = {'Content-Type': 'application/x-www-form-urlencoded'}
     data = {'grant_type': "client_credentials",
             'scopes': 'accounting.transactions accounting.attachments accounting.contacts'}
-    response = requests.post(XERO_TOKEN_URL, headers=headers, auth=HTTPBasicAuth(CLIENT_ID, CLIENT_SECRET), data=data)
+    response = SESSION.post(XERO_TOKEN_URL, headers=headers, auth=HTTPBasicAuth(CLIENT_ID, CLIENT_SECRET), data=data,
+                            timeout=30)
     if response.status_code == 200:
-        print("Obtained token successfully")
         logger.info("Obtained token successfully")
-        return response.json()['access_token']
+        token_data = response.json()
+        save_cached_token(token_data['access_token'], token_data.get('expires_in', 1800))
+        return token_data['access_token']
     else:
-        print(f"Failed to fetch token: {response.status_code} - {response.text}")
         logger.error(f"Failed to fetch token: {response.status_code} - {response.text}")
         sys.exit(1)
 
 
-def get_tenant_id(token):
-    headers = {'Authorization': f"Bearer {token}", 'Accept': 'application/json'}
-    response = requests.get(XERO_CONNECTIONS_URL, headers=headers)
+def refresh_token(rejected_authorization):
+    """Replace an access token Xero has rejected, once for all the workers that saw it fail."""
+    with TOKEN_LOCK:
+        if SESSION.headers.get('Authorization') != rejected_authorization:
+            return
+        logger.info("Access token was rejected, fetching a new one")
+        token = get_token(use_cache=False)
+        SESSION.headers['Authorization'] = f"Bearer {token}"
+
+
+def get_tenant_id(db, use_cache=True):
+    cache_key = f"tenant_id:{CLIENT_ID}"
+    if not use_cache:
+        delete_cached_value(db, cache_key)
+    tenant_id = get_cached_value(db, cache_key)
+    if tenant_id:
+        logger.info(f"Using cached tenant ID: {tenant_id}")
+        return tenant_id
+
+    response = SESSION.get(XERO_CONNECTIONS_URL, timeout=30)
     if response.status_code == 200:
         connections = response.json()
         if connections:
             tenant_id = connections[0]['tenantId']
-            print(f"Using tenant ID: {tenant_id}")
             logger.info(f"Using tenant ID: {tenant_id}")
+            set_cached_value(db, cache_key, tenant_id)
             return tenant_id
         else:
-            print("No tenant found in connections")
             logger.error("No tenant found in connections")
             sys.exit(1)
+    elif response.status_code in STALE_LOOKUP_STATUSES:
+        # Most likely a cached token that has been revoked
+        raise StaleLookupError(f"connections lookup returned {response.status_code}")
     else:
-        print(f"Failed to fetch tenant ID: {response.status_code} - {response.text}")
         logger.error(f"Failed to fetch tenant ID: {response.status_code} - {response.text}")
         sys.exit(1)
 
 
-def get_xero_api(url, token, tenant_id, params=None):
-    headers = {'Authorization': f"Bearer {token}", 'Accept': 'application/json', 'Xero-tenant-id': tenant_id}
-    response = requests.get(url, headers=headers, params=params)
-    return response
+def parse_json(response):
+    """Decode a JSON response body, using orjson when it is installed."""
+    if orjson:
+        return orjson.loads(response.content)
+    return response.json()
 
 
-def get_contact_id(token, tenant_id, contact_name=SUPPLIER_NAME):
+def get_xero_api(url, params=None, **kwargs):
+    """
+    GET from Xero through RATE_LIMITER, retrying minute limit 429s once the limiter's pause is over
+    and retrying once with a new token if the current one has expired during the run
+    """
+    # Auth and tenant headers live on SESSION once main() has authenticated
+    retries = 0
+    refreshed = False
+    while True:
+        RATE_LIMITER.acquire()
+        authorization = SESSION.headers.get('Authorization')
+        response = SESSION.get(url, params=params, timeout=30, **kwargs)
+        RATE_LIMITER.update(response)
+        if response.status_code == 401 and authorization and not refreshed:
+            response.close()
+            refresh_token(authorization)
+            refreshed = True
+        elif response.status_code == 429 and retries < RATE_LIMIT_RETRIES:
+            # A daily limit 429 makes the next acquire() raise DailyLimitReached
+            response.close()
+            retries += 1
+        else:
+            return response
+
+
+def get_contact_id(db, contact_name=SUPPLIER_NAME, use_cache=True):
+    cache_key = f"contact_id:{CLIENT_ID}:{contact_name}"
+    if not use_cache:
+        delete_cached_value(db, cache_key)
+    contact_id = get_cached_value(db, cache_key)
+    if contact_id:
+        logger.info(f"Using cached ContactID for '{contact_name}': {contact_id}")
+        return contact_id
+
     params = {"where": f'Name=="{contact_name}"'}
-    response = get_xero_api(XERO_CONTACTS_URL, token, tenant_id, params=params)
+    response = get_xero_api(XERO_CONTACTS_URL, params=params)
     if response.status_code == 200:
-        contacts = response.json().get('Contacts', [])
+        contacts = parse_json(response).get('Contacts', [])
         if contacts:
             contact_id = contacts[0]['ContactID']
-            print(f"Found '{contact_name}' with ContactID: {contact_id}")
             logger.info(f"Found '{contact_name}' with ContactID: {contact_id}")
+            set_cached_value(db, cache_key, contact_id)
             return contact_id
         else:
-            print(f"No contact found with name '{contact_name}'")
             logger.error(f"No contact found with name '{contact_name}'")
             sys.exit(1)
+    elif response.status_code in STALE_LOOKUP_STATUSES:
+        raise StaleLookupError(f"contact lookup returned {response.status_code}")
     else:
-        print(f"Failed to fetch contact details: {response.status_code} - {response.text}")
         logger.error(f"Failed to fetch contact details: {response.status_code} - {response.text}")
         sys.exit(1)
 
 
-def get_invoices_for_contact(token, tenant_id, contact_id):
+def get_invoice_page(contact_id, page, modified_since=None):
     year, month, day = start_date.year, start_date.month, start_date.day
+    params = {
+        "where": f'Contact.ContactID==Guid("{contact_id}") AND Date>=DateTime({year},{month:02d},{day:02d})',
+        "order": "Date DESC",
+        "page": page,
+        "pageSize": INVOICE_PAGE_SIZE,
+        # Lightweight invoices still carry InvoiceID, InvoiceNumber, DateString and HasAttachments
+        "summaryOnly": "true"
+    }
+    # Only invoices changed since the last completed run are returned, 304 means there are none
+    headers = {'If-Modified-Since': modified_since} if modified_since else None
+    response = get_xero_api(XERO_INVOICES_URL, params=params, headers=headers)
+    if response.status_code == 304:
+        return []
+    elif response.status_code == 200:
+        return parse_json(response).get('Invoices', [])
+    elif response.status_code in STALE_LOOKUP_STATUSES:
+        raise StaleLookupError(f"invoice page {page} returned {response.status_code}")
+    else:
+        logger.error(f"Failed to fetch invoices: {response.status_code} - {response.text}")
+        sys.exit(1)
+
+
+def get_invoices_for_contact(contact_id, modified_since=None):
     today = datetime(2025, 3, 20)
 
     invoices = []
     page = 1
-    while True:
-        params = {
-            "where": f'Contact.ContactID==Guid("{contact_id}") AND Date>=DateTime({year},{month:02d},{day:02d})',
-            "order": "Date DESC",
-            "page": page
-        }
-        response = get_xero_api(XERO_INVOICES_URL, token, tenant_id, params=params)
-        if response.status_code == 200:
-            page_invoices = response.json().get('Invoices', [])
-            if not page_invoices:
+    # Incremental runs usually fit in one page, so try page 1 alone before fetching whole windows
+    window = 1 if modified_since else PAGE_WINDOW
+    # Fetch a window of pages at once, a short page means there is nothing after it
+    with ThreadPoolExecutor(max_workers=PAGE_WINDOW) as executor:
+        while True:
+            try:
+                pages = list(executor.map(lambda p: get_invoice_page(contact_id, p, modified_since),
+                                          range(page, page + window)))
+            except DailyLimitReached:
+                logger.error(f"Stopped fetching invoices at page {page}, daily API limit reached")
                 break
-            invoices.extend(page_invoices)
-            print(f"Fetched page {page}: {len(page_invoices)} invoices (total so far: {len(invoices)})")
-            logger.info(f"Fetched page {page}: {len(page_invoices)} invoices (total so far: {len(invoices)})")
-            page += 1
-            time.sleep(1)
-        else:
-            print(f"Failed to fetch invoices: {response.status_code} - {response.text}")
-            logger.error(f"Failed to fetch invoices: {response.status_code} - {response.text}")
-            sys.exit(1)
+            for offset, page_invoices in enumerate(pages):
+                if not page_invoices:
+                    break
+                invoices.extend(page_invoices)
+                logger.info(
+                    f"Fetched page {page + offset}: {len(page_invoices)} invoices (total so far: {len(invoices)})")
+            if any(len(page_invoices) < INVOICE_PAGE_SIZE for page_invoices in pages):
+                break
+            page += window
+            window = PAGE_WINDOW
 
-    print(
-        f"Found {len(invoices)} invoices for '{SUPPLIER_NAME}' from {start_date.strftime('%Y-%m-%d')} to {today.strftime('%Y-%m-%d')}")
     logger.info(
         f"Found {len(invoices)} invoices for '{SUPPLIER_NAME}' from {start_date.strftime('%Y-%m-%d')} to {today.strftime('%Y-%m-%d')}")
     return invoices
 
 
-def load_processed_invoices():
-    """Load previously processed invoice IDs from the log file."""
-    processed = set()
-    if os.path.exists('xero_download.log'):
-        with open('xero_download.log', 'r') as log_file:
-            for line in log_file:
-                if "Processing invoice:" in line:
-                    parts = line.split("ID: ")
-                    if len(parts) > 1:
-                        invoice_id = parts[1].split(',')[0].strip()
-                        processed.add(invoice_id)
-    return processed
-
-
-def load_downloaded_attachments():
-    """Load previously downloaded attachments from JSON file."""
-    downloaded = set()
-    if os.path.exists(DOWNLOADED_SET_FILE):
+def open_state_db():
+    """Open the state database, creating its tables on first use."""
+    db = sqlite3.connect(STATE_DB_FILE, isolation_level=None, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.execute("CREATE TABLE IF NOT EXISTS processed_invoices (invoice_id TEXT PRIMARY KEY)")
+    db.execute("CREATE TABLE IF NOT EXISTS downloaded_attachments ("
+               "supplier TEXT NOT NULL, unique_name TEXT NOT NULL, PRIMARY KEY (supplier, unique_name))")
+    db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    db.execute("CREATE TABLE IF NOT EXISTS sync_state ("
+               "supplier TEXT NOT NULL, start_date TEXT NOT NULL, modified_after TEXT NOT NULL, "
+               "PRIMARY KEY (supplier, start_date))")
+    return db
+
+
+def get_cached_value(db, key):
+    """Return a cached lookup such as the tenant or contact ID, or None."""
+    row = db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+
+def set_cached_value(db, key, value):
+    """Store a cached lookup, replacing any previous value."""
+    db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?)", (key, value))
+
+
+def delete_cached_value(db, key):
+    """Forget a cached lookup so it is fetched from Xero again."""
+    db.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+
+def migrate_legacy_state(db, supplier_folder):
+    """One-off import of the state older versions kept in the log file and JSON set."""
+    if db.execute("PRAGMA user_version").fetchone()[0] == 0:
+        processed = []
+        if os.path.exists(LOG_FILE) and os.path.getsize(LOG_FILE) > 0:
+            with open(LOG_FILE, 'rb') as log_file, \
+                    mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+                processed = [(match.strip().decode(),) for match in PROCESSED_INVOICE_RE.findall(log_map)]
+        db.executemany("INSERT OR IGNORE INTO processed_invoices VALUES (?)", processed)
+        db.execute("PRAGMA user_version = 1")
+        logger.info(f"Imported {len(processed)} processed invoices from {LOG_FILE}")
+
+    legacy_file = os.path.join(supplier_folder, DOWNLOADED_SET_FILE)
+    if os.path.exists(legacy_file):
         try:
-            with open(DOWNLOADED_SET_FILE, 'r') as f:
-                downloaded = set(json.load(f))
-            logger.info(f"Loaded {len(downloaded)} previously downloaded attachments from {DOWNLOADED_SET_FILE}")
+            with open(legacy_file, 'r') as f:
+                downloaded = json.load(f)
         except (json.JSONDecodeError, IOError) as e:
-            logger.error(f"Failed to load downloaded attachments from {DOWNLOADED_SET_FILE}: {str(e)}")
+            logger.error(f"Failed to load downloaded attachments from {legacy_file}: {str(e)}")
+            return
+        db.executemany("INSERT OR IGNORE INTO downloaded_attachments VALUES (?, ?)",
+                       [(SUPPLIER_NAME, name) for name in downloaded])
+        os.replace(legacy_file, f"{legacy_file}.migrated")
+        logger.info(f"Imported {len(downloaded)} downloaded attachments from {legacy_file}")
+
+
+def load_processed_invoices(db):
+    """Load previously processed invoice IDs from the state database."""
+    return {row[0] for row in db.execute("SELECT invoice_id FROM processed_invoices")}
+
+
+def load_downloaded_attachments(db, supplier_folder):
+    """
+    Load previously downloaded attachments from the supplier folder and the state database
+    Partial downloads left behind by an interrupted run are removed from PARTIAL_DIR
+    """
+    partial_dir = Path(supplier_folder) / PARTIAL_DIR
+    partial_dir.mkdir(exist_ok=True)
+    with os.scandir(partial_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                os.unlink(entry.path)
+
+    with os.scandir(supplier_folder) as entries:
+        downloaded = {entry.name for entry in entries if entry.is_file()}
+    downloaded.update(row[0] for row in db.execute(
+        "SELECT unique_name FROM downloaded_attachments WHERE supplier = ?", (SUPPLIER_NAME,)))
+    logger.info(f"Loaded {len(downloaded)} previously downloaded attachments from {supplier_folder} and {STATE_DB_FILE}")
     return downloaded
 
 
-def save_downloaded_attachments_set(downloaded_set):
-    """Save the downloaded attachments set to JSON file."""
-    try:
-        with open(DOWNLOADED_SET_FILE, 'w') as f:
-            json.dump(list(downloaded_set), f)
-        logger.info(f"Saved {len(downloaded_set)} downloaded attachments to {DOWNLOADED_SET_FILE}")
-    except IOError as e:
-        logger.error(f"Failed to save downloaded attachments to {DOWNLOADED_SET_FILE}: {str(e)}")
+def load_sync_watermark(db):
+    """Return when the last completed run for this supplier and START_DATE saw an invoice change, or None."""
+    row = db.execute("SELECT modified_after FROM sync_state WHERE supplier = ? AND start_date = ?",
+                     (SUPPLIER_NAME, START_DATE)).fetchone()
+    return row[0] if row else None
+
+
+def save_sync_watermark(db, invoices):
+    """Store the latest UpdatedDateUTC of the fetched invoices as the next run's If-Modified-Since."""
+    updated = [int(match.group(1)) for match in
+               (XERO_DATE_RE.match(inv.get('UpdatedDateUTC', '')) for inv in invoices) if match]
+    if not updated:
+        return
+    modified_after = datetime.fromtimestamp(max(updated) / 1000, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S')
+    db.execute("INSERT OR REPLACE INTO sync_state VALUES (?, ?, ?)", (SUPPLIER_NAME, START_DATE, modified_after))
+    logger.info(f"Next run will only fetch invoices modified since {modified_after}")
 
 
-def download_invoice_attachment(token, tenant_id, invoice_id, file_name, inv_num, downloaded_set):
-    # Sanitize both invoice number and file name
-    safe_inv_num = inv_num.replace('/', '_').replace('\\', '_')
-    safe_file_name = file_name.replace('/', '_').replace('\\', '_')
-    unique_file_name = f"{safe_inv_num}_{safe_file_name}"
+def mark_invoice_processed(db, invoice_id):
+    """Record an invoice as processed so later runs skip it."""
+    with STATE_LOCK:
+        db.execute("INSERT OR IGNORE INTO processed_invoices VALUES (?)", (invoice_id,))
+
+
+def mark_attachment_downloaded(db, downloaded_set, unique_file_name):
+    """Record a downloaded attachment in the state database and the in-memory set."""
+    with STATE_LOCK:
+        db.execute("INSERT OR IGNORE INTO downloaded_attachments VALUES (?, ?)", (SUPPLIER_NAME, unique_file_name))
+        downloaded_set.add(unique_file_name)
+
+
+def download_invoice_attachment(db, attachments_url, file_name, safe_inv_num, out_dir, downloaded_set):
+    """Download one attachment unless it is already on disk, returns True if the file is in place."""
+    # Invoice number arrives already sanitized, only the file name needs it
+    unique_file_name = f"{safe_inv_num}_{file_name.translate(SANITIZE_TABLE)}"
 
     if unique_file_name in downloaded_set:
-        print(f"Skipping {unique_file_name} - already downloaded")
         logger.info(f"Skipped {unique_file_name} - already downloaded")
-        return
+        return True
 
-    url = f"{XERO_INVOICES_URL}/{invoice_id}/Attachments/{file_name}"
-    headers = {
-        'Authorization': f"Bearer {token}",
-        'Accept': 'application/octet-stream',
-        'Xero-tenant-id': tenant_id
-    }
+    url = f"{attachments_url}/{file_name}"
 
-    max_attempts = 3
-    attempt = 1
-
-    while attempt <= max_attempts:
-        response = requests.get(url, headers=headers)
-
-        if save_downloaded_attachments(response, unique_file_name, file_name):
-            downloaded_set.add(unique_file_name)
-            save_downloaded_attachments_set(downloaded_set)
-            break
-        elif response.status_code == 429:
-            if attempt < max_attempts:
-                print(f"Rate limit hit (429). Attempt {attempt}/{max_attempts}. Retrying in 10 seconds...")
-                logger.info(f"Rate limit hit (429). Attempt {attempt}/{max_attempts}. Retrying in 10 seconds...")
-                time.sleep(10)
-                attempt += 1
-            else:
-                print(f"Failed to download {file_name} after {max_attempts} attempts due to rate limiting")
-                logger.error(f"Failed to download {file_name} after {max_attempts} attempts due to rate limiting")
-                break
-        else:
-            break
+    # 429s are retried by the session adapter, honouring Xero's Retry-After header
+    with get_xero_api(url, headers=ATTACHMENT_HEADERS, stream=True) as response:
+        saved = save_downloaded_attachments(response, out_dir / unique_file_name, file_name)
+
+    if saved:
+        mark_attachment_downloaded(db, downloaded_set, unique_file_name)
+    return saved
 
 
-def save_downloaded_attachments(response, unique_file_name, file_name):
+def save_downloaded_attachments(response, path, file_name):
     if response.status_code == 200:
-        with open(unique_file_name, 'wb') as f:
-            f.write(response.content)
-        print(f"Downloaded attachment: {unique_file_name}")
-        logger.info(f"Downloaded attachment: {unique_file_name}")
-        time.sleep(1)
+        if path.exists():
+            logger.info(f"Skipped {path.name} - already downloaded")
+            return True
+        # O_EXCL makes creating the partial file the claim on it, so two workers never write the same file
+        part_path = path.parent / PARTIAL_DIR / path.name
+        try:
+            fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            # Another worker owns it, leave this invoice for the next run to confirm
+            logger.info(f"Skipped {path.name} - already being downloaded")
+            return False
+        try:
+            # Honour Content-Encoding while copying straight from the socket
+            response.raw.decode_content = True
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(response.raw, f, length=DOWNLOAD_CHUNK_SIZE)
+            # Only a complete download gets its final name, link fails rather than overwrite an existing file
+            try:
+                os.link(part_path, path)
+            except FileExistsError:
+                logger.info(f"Skipped {path.name} - already downloaded")
+                return True
+            except OSError:
+                # Some filesystems (FAT, network shares) don't support hard links
+                if path.exists():
+                    logger.info(f"Skipped {path.name} - already downloaded")
+                    return True
+                os.replace(part_path, path)
+        finally:
+            part_path.unlink(missing_ok=True)
+        logger.info(f"Downloaded attachment: {path.name}")
         return True
     elif response.status_code == 429:
-        logger.info(f"Rate limit hit: {response.status_code} - {response.text}")
+        logger.error(f"Failed to download {file_name} due to rate limiting: {response.text}")
         return False
     else:
-        print(f"Failed to download {file_name}: {response.status_code} - {response.text}")
         logger.error(f"Failed to download {file_name}: {response.status_code} - {response.text}")
-        time.sleep(1)
+        return False
+
+
+def process_invoice(db, inv, out_dir, downloaded_set):
+    """Fetch and download the attachments for one invoice, returns True if all of them are on disk."""
+    inv_id = inv['InvoiceID']
+    inv_num = inv.get('InvoiceNumber', inv_id)
+    date = inv.get('DateString', 'N/A')
+
+    # Leave the rest unprocessed for the next run once the daily quota is gone
+    if RATE_LIMITER.day_limit_reached:
+        return False
+
+    logger.info(f"Processing invoice: {inv_num} (ID: {inv_id}, Date: {date})")
+
+    # No need to list attachments when Xero already tells us there are none
+    if inv.get('HasAttachments') is False:
+        logger.info(f"No attachments found for invoice {inv_num}")
+        mark_invoice_processed(db, inv_id)
         return True
 
+    try:
+        attachments_url = f"{XERO_INVOICES_URL}/{inv_id}/Attachments"
+        response = get_xero_api(attachments_url)
+        if response.status_code == 200:
+            attachments = parse_json(response).get('Attachments', [])
+            if attachments:
+                safe_inv_num = inv_num.translate(SANITIZE_TABLE)
+                downloaded = []
+                for attachment in attachments:
+                    file_name = attachment['FileName']
+                    logger.info(f"Found attachment: {file_name}")
+                    downloaded.append(download_invoice_attachment(
+                        db, attachments_url, file_name, safe_inv_num, out_dir, downloaded_set))
+                # Leave the invoice unprocessed so the next run retries the failed attachments
+                if not all(downloaded):
+                    logger.error(f"Failed to download some attachments for invoice {inv_num}, it will be retried")
+                    return False
+            else:
+                logger.info(f"No attachments found for invoice {inv_num}")
+            mark_invoice_processed(db, inv_id)
+            return True
+        else:
+            logger.error(f"Failed to fetch attachments for {inv_num}: {response.status_code} - {response.text}")
+            return False
+    except DailyLimitReached:
+        # Leave it unprocessed, the next run picks it up once the limit has reset
+        logger.error(f"Stopped processing invoice {inv_num}, daily API limit reached")
+        return False
+
+
+def connect_to_xero(db, use_cache=True):
+    """Authenticate the session for the tenant and return the supplier's ContactID."""
+    token = get_token(use_cache)
+    SESSION.headers.update({'Authorization': f"Bearer {token}", 'Accept': 'application/json'})
+    SESSION.headers['Xero-tenant-id'] = get_tenant_id(db, use_cache)
+    return get_contact_id(db, use_cache=use_cache)
+
 
 def main():
     try:
-        print("Fetching access token from Xero...")
         logger.info("Starting Xero invoice attachment downloader...")
-        token = get_token()
-        tenant_id = get_tenant_id(token)
+        logger.info("Fetching access token from Xero...")
+        db = open_state_db()
 
-        contact_id = get_contact_id(token, tenant_id)
-        invoices = get_invoices_for_contact(token, tenant_id, contact_id)
+        modified_since = load_sync_watermark(db)
+        if modified_since:
+            logger.info(f"Fetching invoices modified since {modified_since}")
 
-        supplier_folder = os.path.join("invoice_attachments", SUPPLIER_NAME.replace(" ", "_"))
-        if not os.path.exists(supplier_folder):
-            os.makedirs(supplier_folder)
-        os.chdir(supplier_folder)
+        try:
+            contact_id = connect_to_xero(db)
+            invoices = get_invoices_for_contact(contact_id, modified_since)
+        except StaleLookupError as err:
+            # The connection may have moved org or the contact been merged, look everything up once more
+            logger.info(f"Xero rejected the cached lookups ({err}), fetching them again")
+            contact_id = connect_to_xero(db, use_cache=False)
+            invoices = get_invoices_for_contact(contact_id, modified_since)
+
+        supplier_folder = Path("invoice_attachments") / SUPPLIER_NAME.replace(" ", "_")
+        supplier_folder.mkdir(parents=True, exist_ok=True)
+
+        migrate_legacy_state(db, supplier_folder)
 
         # Load previously processed invoices and downloaded attachments
-        processed_invoices = load_processed_invoices()
-        downloaded_set = load_downloaded_attachments()
-
-        new_invoices_processed = 0
-        for inv in invoices:
-            inv_id = inv['InvoiceID']
-            inv_num = inv.get('InvoiceNumber', inv_id)
-            date = inv.get('DateString', 'N/A')
-
-            if inv_id in processed_invoices:
-                print(f"Skipping invoice: {inv_num} (ID: {inv_id}) - already processed")
-                logger.info(f"Skipped invoice: {inv_num} (ID: {inv_id}) - already processed")
-                continue
-
-            print(f"Processing invoice: {inv_num} (ID: {inv_id}, Date: {date})")
-            logger.info(f"Processing invoice: {inv_num} (ID: {inv_id}, Date: {date})")
-
-            attachments_url = f"{XERO_INVOICES_URL}/{inv_id}/Attachments"
-            response = get_xero_api(attachments_url, token, tenant_id)
-            if response.status_code == 200:
-                attachments = response.json().get('Attachments', [])
-                if attachments:
-                    for attachment in attachments:
-                        file_name = attachment['FileName']
-                        print(f"Found attachment: {file_name}")
-                        logger.info(f"Found attachment: {file_name}")
-                        download_invoice_attachment(token, tenant_id, inv_id, file_name, inv_num, downloaded_set)
-                else:
-                    print(f"No attachments found for invoice {inv_num}")
-                    logger.info(f"No attachments found for invoice {inv_num}")
-                new_invoices_processed += 1
-            else:
-                print(f"Failed to fetch attachments for {inv_num}: {response.status_code} - {response.text}")
-                logger.error(f"Failed to fetch attachments for {inv_num}: {response.status_code} - {response.text}")
+        processed_invoices = load_processed_invoices(db)
+        downloaded_set = load_downloaded_attachments(db, supplier_folder)
+
+        # Drop duplicates and already processed invoices before making any further calls
+        unique_invoices = {inv['InvoiceID']: inv for inv in invoices}
+        new_invoices = [inv for inv_id, inv in unique_invoices.items() if inv_id not in processed_invoices]
+        skipped = len(unique_invoices) - len(new_invoices)
+        if skipped:
+            logger.info(f"Skipping {skipped} already processed invoices")
+
+        # Invoices are handled concurrently, RATE_LIMITER keeps us under Xero's limits
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            results = list(executor.map(
+                lambda inv: process_invoice(db, inv, supplier_folder, downloaded_set), new_invoices))
+            new_invoices_processed = sum(results)
+
+        # Only move the watermark on when every invoice and attachment succeeded,
+        # otherwise If-Modified-Since would hide the failed invoices from the next run
+        if all(results) and not RATE_LIMITER.day_limit_reached:
+            save_sync_watermark(db, invoices)
 
-        print(f"Processed {new_invoices_processed} new invoices.")
         logger.info(f"Processed {new_invoices_processed} new invoices.")
-        save_downloaded_attachments_set(downloaded_set)
 
     except Exception as err:
-        print(f"Error occurred: {str(err)}")
         logger.error(f"Error occurred: {str(err)}")
-        save_downloaded_attachments_set(downloaded_set)
         sys.exit(1)
 
 
 if __name__ == "__main__":
-    print("Starting Xero invoice attachment downloader...")
     main()
-    print("Download process completed.")
     logger.info("Download process completed.")
\ No newline at end of file